@@ -1,14 +1,23 @@
 import gradio as gr
 import pyedflib
 import plotly.graph_objs as go
+import csv
+import io
 import numpy as np
-import json
+import pandas as pd
+import functools
+from itertools import chain, islice
+import orjson
+import os
+import threading
+from plotly_resampler import FigureResampler
 
 
-def time_to_seconds(time_str):
-    """Преобразует строку времени в формате HH:MM:SS в секунды."""
-    h, m, s = map(int, time_str.split(':'))
-    return h * 3600 + m * 60 + s
+def time_to_seconds(hours, minutes, seconds):
+    """Преобразует столбцы часов, минут и секунд в массив секунд (NaN для некорректных строк)."""
+    h, m, s = (pd.to_numeric(part, errors='coerce').to_numpy(dtype=np.float64) for part in (hours, minutes, seconds))
+    integral = (np.floor(h) == h) & (np.floor(m) == m) & (np.floor(s) == s)
+    return np.where(integral, h * 3600 + m * 60 + s, np.nan)
 
 
 def seconds_to_time(seconds):
@@ -19,156 +28,255 @@ def seconds_to_time(seconds):
     return f"{int(h):02}:{int(m):02}:{int(s):02}"
 
 
-def load_edf_with_annotations(edf_file, annotations_file):
-    try:
-        # Чтение EDF файла
-        edf = pyedflib.EdfReader(edf_file.name)
-        n_signals = edf.signals_in_file
-        signal_labels = edf.getSignalLabels()
+def format_interval_choice(index, interval):
+    """Формирует подпись интервала для выпадающего списка."""
+    return f"{index + 1}: {seconds_to_time(interval['start'])} - {seconds_to_time(interval['end'])} ({interval['description']})"
+
+
+# Кэш прочитанных сигналов: (путь к файлу, версия файла, метка сигнала) -> np.ndarray (float32)
+_SIGNAL_CACHE = {}
+_SIGNAL_CACHE_SIZE = 4
+# edflib допускает только один открытый дескриптор на файл, а Gradio выполняет обработчики
+# параллельно, поэтому открытие/чтение EDF и работа с кэшем сигналов идут под блокировкой
+_EDF_LOCK = threading.Lock()
+
+
+def file_version(path):
+    """Возвращает (время изменения, размер) файла, чтобы кэши не отдавали устаревшие данные."""
+    return os.path.getmtime(path), os.path.getsize(path)
+
+
+@functools.lru_cache(maxsize=4)
+def read_edf_header(path, version):
+    """Читает метки и частоты дискретизации сигналов EDF файла; version — результат file_version."""
+    with _EDF_LOCK:
+        edf = pyedflib.EdfReader(path)
+        try:
+            signal_labels = edf.getSignalLabels()
+            sample_rate = {signal_labels[i]: edf.getSampleFrequency(i) for i in range(edf.signals_in_file)}
+        finally:
+            edf.close()
+    return tuple(signal_labels), sample_rate
+
+
+def read_signal(path, version, labels, signal_label):
+    """Читает один сигнал из EDF файла, повторные запросы отдаются из кэша."""
+    key = (path, version, signal_label)
+    with _EDF_LOCK:
+        signal_data = _SIGNAL_CACHE.get(key)
+        if signal_data is None:
+            edf = pyedflib.EdfReader(path)
+            try:
+                # Для отображения достаточно float32: вдвое меньше памяти и данных для прореживания
+                signal_data = edf.readSignal(labels.index(signal_label)).astype(np.float32, copy=False)
+            finally:
+                edf.close()
+            if len(_SIGNAL_CACHE) >= _SIGNAL_CACHE_SIZE:
+                # Вытесняем самый старый сигнал, чтобы кэш оставался небольшим
+                del _SIGNAL_CACHE[next(iter(_SIGNAL_CACHE))]
+            _SIGNAL_CACHE[key] = signal_data
+    return signal_data
+
+
+@functools.lru_cache(maxsize=4)
+def get_time_axis(n_samples, fs):
+    """Возвращает временную шкалу в секундах; массив кэшируется и общий, поэтому только для чтения."""
+    time_axis = np.arange(n_samples, dtype=np.float64)
+    time_axis /= float(fs)
+    time_axis.flags.writeable = False
+    return time_axis
 
-        # Получение данных всех сигналов и частоты дискретизации
-        data = {}
-        sample_rate = {}
-        for i in range(n_signals):
-            data[signal_labels[i]] = edf.readSignal(i)
-            sample_rate[signal_labels[i]] = edf.getSampleFrequency(i)
 
-        edf.close()
+def load_edf_with_annotations(edf_file, annotations_file):
+    try:
+        # Чтение заголовка EDF файла (повторная загрузка того же файла берётся из кэша),
+        # сами сигналы читаются по запросу в plot_signal
+        version = file_version(edf_file.name)
+        signal_labels, sample_rate = read_edf_header(edf_file.name, version)
+        signal_labels = list(signal_labels)
 
         # Проверка загрузки сигналов
         if not signal_labels:
             print("No signals found in the EDF file.")
         else:
-            print(f"Signals loaded: {signal_labels}")
-
-        # Чтение аннотаций из текстового файла
-        annotations = []
-        with open(annotations_file.name, 'r') as f:
-            for line in f:
-                parts = line.strip().split()
-                if len(parts) != 3:
-                    print(f"Skipping invalid line: {line}")
-                    continue
-                try:
-                    onset = time_to_seconds(parts[1])
-                    description = parts[2]
-                    annotations.append({'time': onset, 'description': description})
-                except ValueError as e:
-                    print(f"Skipping line with invalid values: {line} ({e})")
-
-        # Создание интервалов для аннотаций
-        intervals = []
-        for i in range(0, len(annotations) - 1, 2):
-            if i + 1 < len(annotations):
-                start_annotation = annotations[i]
-                end_annotation = annotations[i + 1]
-                if (start_annotation['description'][:-1] == end_annotation['description'][:-1] and
-                        start_annotation['description'][-1] == '1' and end_annotation['description'][-1] == '2'):
-                    intervals.append({
-                        'start': start_annotation['time'],
-                        'end': end_annotation['time'],
-                        'description': start_annotation['description'][:-1]  # swd, is, ds
-                    })
+            print(f"Signals found: {signal_labels}")
+
+        edf_data = {'path': edf_file.name, 'version': version, 'labels': signal_labels, 'fs': sample_rate}
+
+        # Чтение аннотаций из текстового файла целиком, строки с неверным числом столбцов пропускаются
+        with open(annotations_file.name, 'rb', buffering=1 << 20) as f:
+            raw = f.read()
+        # Двоеточия в HH:MM:SS заменяются пробелами, чтобы C-парсер pandas сразу разобрал часы, минуты
+        # и секунды в отдельные числовые столбцы. Лишний столбец 'extra' нужен, чтобы отбросить строки
+        # с более чем тремя полями
+        rows = pd.read_csv(io.BytesIO(raw.replace(b':', b' ')), sep=r'\s+', header=None,
+                           names=['index', 'h', 'm', 's', 'description', 'extra'], index_col=False,
+                           dtype={'index': str, 'description': str, 'extra': str},
+                           on_bad_lines='warn', quoting=csv.QUOTE_NONE)
+        onsets = time_to_seconds(rows['h'], rows['m'], rows['s'])
+        valid = ~np.isnan(onsets) & rows['description'].notna().to_numpy() & rows['extra'].isna().to_numpy()
+        if not valid.all():
+            print(f"Skipping lines with invalid values: {rows[~valid].values.tolist()}")
+        onsets = onsets[valid].astype(np.int64)
+        descriptions = rows['description'].to_numpy(dtype=str)[valid]
+
+        # Создание интервалов для аннотаций: аннотации идут парами (начало, конец)
+        n_pairs = len(onsets) // 2
+        start_descriptions = descriptions[0:2 * n_pairs:2]
+        end_descriptions = descriptions[1:2 * n_pairs:2]
+        prefixes = pd.Series(start_descriptions, dtype=str).str[:-1].to_numpy()  # swd, is, ds
+        mask = ((prefixes == pd.Series(end_descriptions, dtype=str).str[:-1].to_numpy()) &
+                np.char.endswith(start_descriptions, '1') & np.char.endswith(end_descriptions, '2'))
+        intervals = [{'start': start, 'end': end, 'description': description}
+                     for start, end, description in zip(onsets[0:2 * n_pairs:2][mask].tolist(),
+                                                        onsets[1:2 * n_pairs:2][mask].tolist(),
+                                                        prefixes[mask].tolist())]
 
         print(f"Intervals created: {intervals}")
-        interval_choices = [
-            f"{i + 1}: {seconds_to_time(interval['start'])} - {seconds_to_time(interval['end'])} ({interval['description']})"
-            for i, interval in enumerate(intervals)]
-        return data, sample_rate, intervals, gr.update(choices=signal_labels), gr.update(
+        interval_choices = [format_interval_choice(i, interval) for i, interval in enumerate(intervals)]
+        return edf_data, intervals, [], gr.update(choices=signal_labels), gr.update(
             choices=interval_choices), interval_choices, ""
     except Exception as e:
         print(f"Error loading EDF or annotations: {str(e)}")
-        return {}, {}, [], gr.update(choices=[]), gr.update(choices=[]), [], str(e)
+        return {}, [], [], gr.update(choices=[]), gr.update(choices=[]), [], str(e)
 
 
-def plot_signal(edf_data, sample_rate, intervals, signal_label, markup_intervals):
-    if not edf_data or not signal_label:
-        return None
-
-    # Получение данных для выбранного сигнала и частоты дискретизации
-    signal_data = edf_data.get(signal_label, [])
-    fs = sample_rate.get(signal_label, 1)  # Частота дискретизации (по умолчанию 1 для безопасности)
+# Определение более насыщенных цветов для различных фаз
+PHASE_COLORS = {
+    'swd': 'rgba(255, 0, 0, 0.7)',  # Более насыщенный красный для SWD
+    'is': 'rgba(0, 255, 0, 0.7)',  # Более насыщенный зеленый для IS
+    'ds': 'rgba(0, 0, 255, 0.7)'  # Более насыщенный синий для DS
+}
 
-    # Создание временной шкалы
-    time_axis = np.arange(len(signal_data)) / fs
 
-    # Создание интерактивного графика с помощью plotly
-    fig = go.Figure()
-    fig.add_trace(go.Scatter(x=time_axis, y=signal_data, mode='lines', name=signal_label))
-
-    # Определение более насыщенных цветов для различных фаз
-    phase_colors = {
-        'swd': 'rgba(255, 0, 0, 0.7)',  # Более насыщенный красный для SWD
-        'is': 'rgba(0, 255, 0, 0.7)',  # Более насыщенный зеленый для IS
-        'ds': 'rgba(0, 0, 255, 0.7)'  # Более насыщенный синий для DS
-    }
-
-    # Добавление цветных полос для аннотаций
-    for interval in intervals + markup_intervals:
+def annotation_shapes(intervals, markup_intervals, y_range):
+    """Строит цветные полосы для аннотаций и пользовательской разметки."""
+    y_min, y_max = y_range
+    shapes = []
+    for interval in chain(intervals, markup_intervals):
         description_lower = interval['description'].lower()
-        color = phase_colors.get(description_lower, 'rgba(0, 0, 0, 0)')  # Черный цвет по умолчанию
-
-        fig.add_shape(type='rect',
-                      x0=interval['start'], x1=interval['end'],
-                      y0=min(signal_data), y1=max(signal_data),
-                      fillcolor=color, opacity=0.7, line_width=0)
-
+        color = PHASE_COLORS.get(description_lower, 'rgba(0, 0, 0, 0)')  # Черный цвет по умолчанию
+
+        shapes.append(dict(type='rect',
+                           x0=interval['start'], x1=interval['end'],
+                           y0=y_min, y1=y_max,
+                           fillcolor=color, opacity=0.7, line_width=0))
+    return shapes
+
+
+@functools.lru_cache(maxsize=4)
+def view_slice(n_samples, fs, view_start, view_end):
+    """Переводит окно просмотра в секундах в границы отсчётов; без окна (или при неверном окне) — весь сигнал."""
+    i0 = int(view_start * fs) if view_start and view_start > 0 else 0
+    i1 = int(np.ceil(view_end * fs)) + 1 if view_end else n_samples
+    i0, i1 = min(i0, n_samples), min(i1, n_samples)
+    if i1 - i0 < 2:
+        return 0, n_samples
+    return i0, i1
+
+
+@functools.lru_cache(maxsize=4)
+def build_base_figure(path, version, labels, signal_label, fs, view_start=None, view_end=None):
+    """Строит график окна сигнала без разметки; результат кэшируется и не должен изменяться."""
+    # Получение данных для выбранного сигнала
+    signal_data = read_signal(path, version, labels, signal_label)
+
+    # Создание временной шкалы и выбор окна просмотра (срезы — представления, без копирования)
+    time_axis = get_time_axis(len(signal_data), fs)
+    i0, i1 = view_slice(len(signal_data), fs, view_start, view_end)
+    time_axis, signal_data = time_axis[i0:i1], signal_data[i0:i1]
+
+    # Создание интерактивного графика с помощью plotly, в браузер передаются не более 2000
+    # прореженных (MinMaxLTTB) точек окна: чем уже окно, тем подробнее сигнал, а окно
+    # короче 2000 отсчётов показывается без прореживания. gr.Plot не пересчитывает
+    # прореживание при масштабировании в браузере, поэтому детали смотрятся через окно
+    fig = FigureResampler(go.Figure(), default_n_shown_samples=2000,
+                          resampled_trace_prefix_suffix=('', ''), show_mean_aggregation_size=False)
+    fig.add_trace(go.Scattergl(mode='lines', name=signal_label), hf_x=time_axis, hf_y=signal_data)
+
+    # uirevision сохраняет масштаб пользователя при обновлении разметки того же окна сигнала,
+    # явный диапазон оси не даёт полосам разметки вне окна растянуть график
     fig.update_layout(
         title=f"Сигнал: {signal_label}",
         xaxis_title="Время (секунды)",
         yaxis_title="Амплитуда",
-        showlegend=True
+        xaxis_range=[float(time_axis[0]), float(time_axis[-1])],
+        showlegend=True,
+        uirevision=f"{signal_label}:{i0}:{i1}"
     )
 
+    # Диапазон амплитуд окна задаёт высоту цветных полос аннотаций
+    y_range = (float(signal_data.min()), float(signal_data.max()))
+    return fig, y_range
+
+
+def overlay_shapes(base_figure, y_range, intervals, markup_intervals):
+    """Возвращает копию графика с полосами разметки; копируются только прореженные точки и layout."""
+    fig = go.Figure(data=base_figure.data, layout=base_figure.layout)
+    fig.update_layout(shapes=annotation_shapes(intervals, markup_intervals, y_range))
     return fig
 
 
-def add_markup(start_time, end_time, label, markup_intervals):
+def plot_signal(edf_data, intervals, signal_label, markup_intervals, view_start=None, view_end=None):
+    if not edf_data or not signal_label:
+        return None
+
+    # Частота дискретизации (по умолчанию 1 для безопасности)
+    fs = edf_data['fs'].get(signal_label, 1)
+    base_figure, y_range = build_base_figure(edf_data['path'], edf_data['version'],
+                                             tuple(edf_data['labels']), signal_label, fs, view_start, view_end)
+    return overlay_shapes(base_figure, y_range, intervals, markup_intervals)
+
+
+def add_markup(start_time, end_time, label, markup_intervals, interval_choices):
     """Добавляет пользовательскую разметку."""
-    markup_intervals.append({'start': start_time, 'end': end_time, 'description': label})
-    return markup_intervals
+    interval = {'start': start_time, 'end': end_time, 'description': label}
+    markup_intervals.append(interval)
+    interval_choices.append(format_interval_choice(len(interval_choices), interval))
+    return markup_intervals, interval_choices, gr.update(choices=interval_choices)
 
 
-def edit_markup(selected_interval, start_time, end_time, label, existing_intervals, markup_intervals):
+def edit_markup(selected_interval, start_time, end_time, label, existing_intervals, markup_intervals, interval_choices):
     """Редактирует существующую разметку."""
-    all_intervals = existing_intervals + markup_intervals
     index = int(selected_interval.split(":")[0]) - 1
-    interval = all_intervals[index]
+    if index < len(existing_intervals):
+        interval = existing_intervals[index]
+    else:
+        interval = markup_intervals[index - len(existing_intervals)]
     interval['start'] = start_time
     interval['end'] = end_time
     interval['description'] = label
-    interval_choices = [
-        f"{i + 1}: {seconds_to_time(interval['start'])} - {seconds_to_time(interval['end'])} ({interval['description']})"
-        for i, interval in enumerate(all_intervals)]
-    return all_intervals, interval_choices
+    interval_choices[index] = format_interval_choice(index, interval)
+    return existing_intervals, markup_intervals, interval_choices, gr.update(choices=interval_choices, value=interval_choices[index])
 
 
-def delete_markup(selected_interval, existing_intervals, markup_intervals):
+def delete_markup(selected_interval, existing_intervals, markup_intervals, interval_choices):
     """Удаляет существующую разметку."""
-    all_intervals = existing_intervals + markup_intervals
     index = int(selected_interval.split(":")[0]) - 1
-    del all_intervals[index]
-    interval_choices = [
-        f"{i + 1}: {seconds_to_time(interval['start'])} - {seconds_to_time(interval['end'])} ({interval['description']})"
-        for i, interval in enumerate(all_intervals)]
-    return all_intervals, interval_choices
+    if index < len(existing_intervals):
+        del existing_intervals[index]
+    else:
+        del markup_intervals[index - len(existing_intervals)]
+    # Номера в подписях сдвигаются, поэтому пересобираются только подписи после удалённой
+    tail = islice(chain(existing_intervals, markup_intervals), index, None)
+    interval_choices[index:] = [format_interval_choice(i, interval) for i, interval in enumerate(tail, start=index)]
+    return existing_intervals, markup_intervals, interval_choices, gr.update(choices=interval_choices, value=None)
 
 
 def save_markup_to_file(markup_intervals, existing_intervals, filename_json, filename_txt):
     """Сохраняет разметку в JSON и TXT файлы."""
     all_intervals = existing_intervals + markup_intervals
 
-    # Сохранение в JSON файл
-    with open(filename_json, 'w') as f:
-        json.dump(all_intervals, f, ensure_ascii=False, indent=4)
+    # Сохранение в JSON файл (orjson пишет UTF-8 без экранирования, как ensure_ascii=False)
+    with open(filename_json, 'wb') as f:
+        f.write(orjson.dumps(all_intervals, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
 
-    # Сохранение в TXT файл
+    # Сохранение в TXT файл одной записью
+    lines = [f"{i+1}  {seconds_to_time(interval['start'])}  {interval['description']}1\n"
+             f"{i+1}  {seconds_to_time(interval['end'])}    {interval['description']}2\n"
+             for i, interval in enumerate(all_intervals)]
     with open(filename_txt, 'w') as f:
-        for i, interval in enumerate(all_intervals):
-            start_time = seconds_to_time(interval['start'])
-            end_time = seconds_to_time(interval['end'])
-            f.write(f"{i+1}  {start_time}  {interval['description']}1\n")
-            f.write(f"{i+1}  {end_time}    {interval['description']}2\n")
+        f.write(''.join(lines))
 
     return f"Markup saved to {filename_json} and {filename_txt}"
 
@@ -190,16 +298,21 @@ with gr.Blocks() as demo:
     # График для визуализации
     plot_output = gr.Plot()
 
+    # Окно просмотра: подробность графика задаётся шириной окна (пустые поля — вся запись)
+    view_start_input = gr.Number(label="View Start (seconds)")
+    view_end_input = gr.Number(label="View End (seconds)")
+    view_button = gr.Button("Show View")
+
     # Блок для добавления разметки
     gr.Markdown("## Добавление разметки")
     start_time_input = gr.Number(label="Start Time (seconds)")
     end_time_input = gr.Number(label="End Time (seconds)")
     label_input = gr.Dropdown(choices=["swd", "is", "ds"], label="Label")
     add_markup_button = gr.Button("Add Markup")
-# Состояния для хранения данных EDF, частоты дискретизации и аннотаций
+# Состояния для хранения метаданных EDF (путь, метки, частоты дискретизации) и аннотаций
     edf_data_output = gr.State()
-    sample_rate_output = gr.State()
     annotations_output = gr.State([])
+    markup_intervals_state = gr.State([])
     interval_choices_output = gr.State([])
 
     # Блок для редактирования и удаления разметки
@@ -219,55 +332,54 @@ with gr.Blocks() as demo:
     load_button.click(
         fn=load_edf_with_annotations,
         inputs=[file_input, annotations_input],
-        outputs=[edf_data_output, sample_rate_output, annotations_output, signal_dropdown, selected_interval, error_output]
+        outputs=[edf_data_output, annotations_output, markup_intervals_state, signal_dropdown, selected_interval, interval_choices_output, error_output]
     )
 
     add_markup_button.click(
         fn=add_markup,
-        inputs=[start_time_input, end_time_input, label_input, annotations_output],
-        outputs=annotations_output
-    ).then(
-        fn=lambda existing_intervals, markup_intervals: (
-            existing_intervals + markup_intervals,
-            [f"{i+1}: {seconds_to_time(interval['start'])} - {seconds_to_time(interval['end'])} ({interval['description']})" for i, interval in enumerate(existing_intervals + markup_intervals)]
-        ),
-        inputs=[annotations_output, annotations_output],
-        outputs=[annotations_output, interval_choices_output]
+        inputs=[start_time_input, end_time_input, label_input, markup_intervals_state, interval_choices_output],
+        outputs=[markup_intervals_state, interval_choices_output, selected_interval]
     ).then(
         fn=plot_signal,
-        inputs=[edf_data_output, sample_rate_output, annotations_output, signal_dropdown, annotations_output],
+        inputs=[edf_data_output, annotations_output, signal_dropdown, markup_intervals_state, view_start_input, view_end_input],
         outputs=plot_output
     )
 
     edit_markup_button.click(
         fn=edit_markup,
-        inputs=[selected_interval, edit_start_time_input, edit_end_time_input, edit_label_input, annotations_output, annotations_output],
-        outputs=[annotations_output, interval_choices_output]
+        inputs=[selected_interval, edit_start_time_input, edit_end_time_input, edit_label_input, annotations_output, markup_intervals_state, interval_choices_output],
+        outputs=[annotations_output, markup_intervals_state, interval_choices_output, selected_interval]
     ).then(
         fn=plot_signal,
-        inputs=[edf_data_output, sample_rate_output, annotations_output, signal_dropdown, annotations_output],
+        inputs=[edf_data_output, annotations_output, signal_dropdown, markup_intervals_state, view_start_input, view_end_input],
         outputs=plot_output
     )
 
     delete_markup_button.click(
         fn=delete_markup,
-        inputs=[selected_interval, annotations_output, annotations_output],
-        outputs=[annotations_output, interval_choices_output]
+        inputs=[selected_interval, annotations_output, markup_intervals_state, interval_choices_output],
+        outputs=[annotations_output, markup_intervals_state, interval_choices_output, selected_interval]
     ).then(
         fn=plot_signal,
-        inputs=[edf_data_output, sample_rate_output, annotations_output, signal_dropdown, annotations_output],
+        inputs=[edf_data_output, annotations_output, signal_dropdown, markup_intervals_state, view_start_input, view_end_input],
         outputs=plot_output
     )
 
     save_markup_button.click(
         fn=save_markup_to_file,
-        inputs=[annotations_output, annotations_output, gr.Textbox(label="Filename JSON", value="markup.json"), gr.Textbox(label="Filename TXT", value="markup.txt")],
+        inputs=[markup_intervals_state, annotations_output, gr.Textbox(label="Filename JSON", value="markup.json"), gr.Textbox(label="Filename TXT", value="markup.txt")],
         outputs=gr.Textbox(label="Save Status")
     )
 
     signal_dropdown.change(
         fn=plot_signal,
-        inputs=[edf_data_output, sample_rate_output, annotations_output, signal_dropdown, annotations_output],
+        inputs=[edf_data_output, annotations_output, signal_dropdown, markup_intervals_state, view_start_input, view_end_input],
+        outputs=plot_output
+    )
+
+    view_button.click(
+        fn=plot_signal,
+        inputs=[edf_data_output, annotations_output, signal_dropdown, markup_intervals_state, view_start_input, view_end_input],
         outputs=plot_output
     )
 
@@ -278,6 +390,9 @@ with gr.Blocks() as demo:
     error_output
     signal_dropdown
     plot_output
+    view_start_input
+    view_end_input
+    view_button
     start_time_input
     end_time_input
     label_input